@@ -1,7 +1,8 @@
 import os, sys
 import numpy as np
-from PIL import Image
 import json
+import cv2
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 from src import utils
 
@@ -36,35 +37,18 @@ def get_num_pos(point_lists):
         num_pos[image] = len(all_maps)
     return num_pos
 
-def get_medians(point_lists, mode='image', thresh=50):
-    medians = {}
-    if mode == 'image':
-        for image in point_lists:
-            clickmaps = point_lists[image]
-            num_clicks = []
-            for clickmap in clickmaps:
-                num_clicks.append(len(clickmap))
-            medians[image] = np.percentile(num_clicks, thresh)
-    elif mode == 'category':
-        for image in point_lists:
-            category = image.split('/')[0]
-            if category not in medians.keys():
-                medians[category] = []
-            clickmaps = point_lists[image]
-            for clickmap in clickmaps:
-                medians[category].append(len(clickmap))
-        for category in medians:
-            medians[category] = np.percentile(medians[category], thresh)
-    elif mode == 'all':
-        num_clicks = []
-        for image in point_lists:
-            clickmaps = point_lists[image]
-            for clickmap in clickmaps:
-                num_clicks.append(len(clickmap))
-        medians['all'] = np.percentile(num_clicks, thresh)
-    else:
-        raise NotImplementedError(mode)
-    return medians
+def load_image(image_path, size=None):
+    # Keep the file's channels (gray, RGB or RGBA) as PIL would, but in RGB(A) order
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(image_path)
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    if size is not None:
+        image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_CUBIC)  # (width, height), as for PIL
+    return image
 
 
 if __name__ == "__main__":
@@ -79,6 +63,8 @@ if __name__ == "__main__":
 
     # Load config
     config = utils.process_config(config_file)
+    if not config["debug"]:
+        plt.switch_backend("Agg")  # Only debug runs show figures, so skip GUI backend setup
     clickme_data = utils.process_clickme_data(
         config["clickme_data"],
         config["filter_mobile"])
@@ -160,12 +146,12 @@ if __name__ == "__main__":
         fck = np.asarray([k for k in final_clickmaps.keys()])
         for image_file in config["display_image_keys"]:
             image_path = os.path.join(config["image_path"], image_file)
-            image = Image.open(image_path)
+            metadata_size = None
             if metadata:
                 click_match = [k_ for k_ in final_clickmaps.keys() if image_file in k_]
                 assert len(click_match) == 1, "Clickmap not found"
                 metadata_size = metadata[click_match[0]]
-                image = image.resize(metadata_size)
+            image = load_image(image_path, metadata_size)
             image_name = "_".join(image_path.split('/')[-2:])
             check = fck == image_file
             if check.any():
@@ -178,24 +164,28 @@ if __name__ == "__main__":
                 print("Image {} not found in final clickmaps".format(image_file))
 
         # And plot
+        if not config["debug"]:
+            fig, axes = plt.subplots(1, 2)  # Agg figures can be cleared and reused for every image
         for k in img_heatmaps.keys():
-            f = plt.figure()
-            plt.subplot(1, 2, 1)
-            plt.imshow(np.asarray(img_heatmaps[k]["image"]))
-            plt.axis("off")
-            plt.subplot(1, 2, 2)
-            plt.imshow(img_heatmaps[k]["heatmap"].mean(0))
-            plt.axis("off")
-            plt.savefig(os.path.join(image_output_dir, k.split(os.path.sep)[-1]))
+            if config["debug"]:
+                fig, axes = plt.subplots(1, 2)  # Closing a shown window destroys its figure
+            for ax in axes:
+                ax.clear()
+                ax.axis("off")
+            axes[0].imshow(np.asarray(img_heatmaps[k]["image"]))
+            axes[1].imshow(img_heatmaps[k]["heatmap"].mean(0))
+            fig.savefig(os.path.join(image_output_dir, k.split(os.path.sep)[-1]))
             if config["debug"]:
                 plt.show()
-            plt.close()
+                plt.close(fig)
+        if not config["debug"]:
+            plt.close(fig)
 
     # Get median number of clicks
     percentile_thresh = config["percentile_thresh"]
-    medians = get_medians(final_clickmaps, 'image', thresh=percentile_thresh)
-    medians.update(get_medians(final_clickmaps, 'category', thresh=percentile_thresh))
-    medians.update(get_medians(final_clickmaps, 'all', thresh=percentile_thresh))
+    medians = utils.get_medians(final_clickmaps, 'image', thresh=percentile_thresh)
+    medians.update(utils.get_medians(final_clickmaps, 'category', thresh=percentile_thresh))
+    medians.update(utils.get_medians(final_clickmaps, 'all', thresh=percentile_thresh))
     medians_json = json.dumps(medians, indent=4)
 
     # Save data
@@ -206,26 +196,30 @@ if __name__ == "__main__":
     with open(os.path.join(output_dir, config["processed_medians"]), 'w') as f:
         f.write(medians_json)
 
-    img_heatmaps = {}
+    image_names, image_sizes, heatmaps = [], [], []
     for i, img_name in enumerate(final_keep_index):
         if not os.path.exists(os.path.join(config["image_path"], img_name)):
             print(os.path.join(config["image_path"], img_name))
             continue
         if img_name not in final_clickmaps.keys():
             continue
-        hmp = all_clickmaps[i]
-        img = Image.open(os.path.join(config["image_path"], img_name))
         if metadata:
             click_match = [k_ for k_ in final_clickmaps.keys() if img_name in k_]
             assert len(click_match) == 1, "Clickmap not found"
-            metadata_size = metadata[click_match[0]]
-            img = img.resize(metadata_size)
-
-        img_heatmaps[img_name] = {"image":img, "heatmap":hmp}
+            image_sizes.append(metadata[click_match[0]])
+        else:
+            image_sizes.append(None)
+        image_names.append(img_name)
+        heatmaps.append(all_clickmaps[i])
+
+    # Load images in parallel, decoding overlaps with disk reads
+    image_paths = [os.path.join(config["image_path"], img_name) for img_name in image_names]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        images = list(executor.map(load_image, image_paths, image_sizes))
+    img_heatmaps = {img_name: {"image": img, "heatmap": hmp} for img_name, img, hmp in zip(image_names, images, heatmaps)}
     print(len(img_heatmaps))
 
     # Patch: Sometimes img_heatmaps is too large
-    import pdb;pdb.set_trace()
     if len(img_heatmaps) > 10000:
         os.makedirs(os.path.join(output_dir, config["experiment_name"]), exist_ok=True)
         for hn, hm in img_heatmaps.keys():
@@ -4,45 +4,6 @@ from PIL import Image
 from src import utils
 from matplotlib import pyplot as plt
 from tqdm import tqdm
-from joblib import Parallel, delayed
-
-
-def compute_inner_correlations(i, all_clickmaps, category_indices, metric):
-    category_index = category_indices[i]
-    inner_correlations = []
-    instance_correlations = {}
-
-    if i not in instance_correlations.keys():
-        instance_correlations[i] = []
-
-    # Reference map is the ith map
-    reference_map = all_clickmaps[i].mean(0)
-    reference_map = (reference_map - reference_map.min()) / (reference_map.max() - reference_map.min())
-
-    # Test map is a random subject from a different image
-    sub_vec = np.where(category_indices != category_index)[0]
-    rand_map = np.random.choice(sub_vec)
-    test_map = all_clickmaps[rand_map]
-    num_subs = len(test_map)
-    rand_sub = np.random.choice(num_subs)
-    test_map = test_map[rand_sub]
-    test_map = (test_map - test_map.min()) / (test_map.max() - test_map.min())
-
-    if metric.lower() == "crossentropy":
-        correlation = utils.compute_crossentropy(test_map, reference_map)
-    elif metric.lower() == "auc":
-        correlation = utils.compute_AUC(test_map, reference_map)
-    elif metric.lower() == "rsa":
-        correlation = utils.compute_RSA(test_map, reference_map)
-    elif metric.lower() == "spearman":
-        correlation = utils.compute_spearman_correlation(test_map, reference_map)
-    else:
-        raise ValueError(f"Invalid metric: {metric}")
-
-    inner_correlations.append(correlation)
-    instance_correlations[i].append(correlation)
-
-    return inner_correlations, instance_correlations
 
 
 def main(
@@ -66,6 +27,7 @@ def main(
         participant_filter=False,
         file_inclusion_filter=False,
         file_exclusion_filter=False,
+        cache_file=None,
     ):
     """
     Calculate split-half correlations for clickmaps across different image categories.
@@ -79,6 +41,7 @@ def main(
         blur_size (int): Size of the Gaussian blur kernel.
         blur_sigma (float): Sigma value for the Gaussian blur kernel.
         image_shape (list): Shape of the image [height, width].
+        cache_file (str): If set, load prepared maps from this file when it exists, otherwise save them to it.
 
     Returns:
         tuple: A tuple containing two elements:
@@ -87,36 +50,46 @@ def main(
     """
     assert blur_sigma_function is not None, "Blur sigma function needs to be provided."
 
-    # Process files in serial
-    clickmaps, _ = utils.process_clickmap_files(
-        clickme_data=clickme_data,
-        image_path=clickme_image_folder,
-        min_clicks=min_clicks,
-        max_clicks=max_clicks,
-        file_inclusion_filter=file_inclusion_filter,
-        file_exclusion_filter=file_exclusion_filter)
-
-    # Filter classes if requested
-    if class_filter_file:
-        clickmaps = utils.filter_classes(
-            clickmaps=clickmaps,
-            class_filter_file=class_filter_file)
-
-    # Filter participants if requested
-    if participant_filter:
-        clickmaps = utils.filter_participants(clickmaps)
-
-    # Prepare maps
-    final_clickmaps, all_clickmaps, categories, _ = utils.prepare_maps(
-        final_clickmaps=clickmaps,
-        blur_size=blur_size,
-        blur_sigma=blur_sigma,
-        image_shape=image_shape,
-        min_pixels=min_pixels,
-        min_subjects=min_subjects,
-        metadata=metadata,
-        blur_sigma_function=blur_sigma_function,
-        center_crop=center_crop)
+    if cache_file and os.path.exists(cache_file):
+        print(f"Loading prepared maps from {cache_file}")
+        final_clickmaps, flat_clickmaps, offsets, categories = utils.load_prepared_maps(cache_file)
+    else:
+        # Process files in serial
+        clickmaps, _ = utils.process_clickmap_files(
+            clickme_data=clickme_data,
+            image_path=clickme_image_folder,
+            min_clicks=min_clicks,
+            max_clicks=max_clicks,
+            file_inclusion_filter=file_inclusion_filter,
+            file_exclusion_filter=file_exclusion_filter)
+
+        # Filter classes if requested
+        if class_filter_file:
+            clickmaps = utils.filter_classes(
+                clickmaps=clickmaps,
+                class_filter_file=class_filter_file)
+
+        # Filter participants if requested
+        if participant_filter:
+            clickmaps = utils.filter_participants(clickmaps)
+
+        # Prepare maps
+        final_clickmaps, all_clickmaps, categories, _ = utils.prepare_maps(
+            final_clickmaps=clickmaps,
+            blur_size=blur_size,
+            blur_sigma=blur_sigma,
+            image_shape=image_shape,
+            min_pixels=min_pixels,
+            min_subjects=min_subjects,
+            metadata=metadata,
+            blur_sigma_function=blur_sigma_function,
+            center_crop=center_crop)
+        flat_clickmaps, offsets = utils.pack_clickmaps(all_clickmaps)
+        if cache_file:
+            utils.save_prepared_maps(cache_file, final_clickmaps, flat_clickmaps, offsets, categories)
+
+    # Per-image stacks are views into the packed maps, so the scores below never copy the dataset
+    all_clickmaps = utils.unpack_clickmaps(flat_clickmaps, offsets)
 
     if debug:
         for imn in range(len(final_clickmaps)):
@@ -133,24 +106,20 @@ def main(
             plt.subplot(4,5,20);plt.imshow(np.asarray(image_data)[16:-16, 16:-16]);plt.axis('off')
             plt.show()
 
-    # Compute scores
+    # Compute scores for every held-out subject of every image at once
+    num_subs = np.diff(offsets)
+    image_ids = np.repeat(np.arange(len(all_clickmaps)), num_subs)
+    total_maps = np.add.reduceat(flat_clickmaps, offsets[:-1], axis=0)
     all_correlations = []
-    for clickmaps in tqdm(all_clickmaps, desc="Processing ceiling", total=len(all_clickmaps)):
-        for i in range(len(clickmaps)):
-            test_map = clickmaps[i]
-            test_map = (test_map - test_map.min()) / (test_map.max() - test_map.min())
-            remaining_maps = clickmaps[~np.in1d(np.arange(len(clickmaps)), i)].mean(0)
-            remaining_maps = (remaining_maps - remaining_maps.min()) / (remaining_maps.max() - remaining_maps.min())
-            if metric.lower() == "crossentropy":
-                correlation = utils.compute_crossentropy(test_map, remaining_maps)
-            elif metric.lower() == "auc":
-                correlation = utils.compute_AUC(test_map, remaining_maps)
-            elif metric.lower() == "spearman":
-                correlation = utils.compute_spearman_correlation(test_map, remaining_maps)
-            else:
-                raise ValueError(f"Invalid metric: {metric}")
-            all_correlations.append(correlation)
-    all_correlations = np.asarray(all_correlations)
+    chunk_size = 1024  # Bounds the mean-of-rest maps held in memory at once
+    for start in tqdm(range(0, len(flat_clickmaps), chunk_size), desc="Processing ceiling"):
+        test_indices = np.arange(start, min(start + chunk_size, len(flat_clickmaps)))
+        chunk_ids = image_ids[test_indices]
+        remaining_maps = total_maps[chunk_ids] - flat_clickmaps[test_indices]
+        remaining_maps /= (num_subs[chunk_ids] - 1)[:, None, None]
+        utils.normalize_maps(remaining_maps, out=remaining_maps)  # Held-out maps are normalized inside compute_pair_scores
+        all_correlations.append(utils.compute_pair_scores(flat_clickmaps, test_indices, remaining_maps, metric))
+    all_correlations = np.concatenate(all_correlations)
 
     # Filter for foreground mask overlap if requested
     if mask_dir:
@@ -161,17 +130,25 @@ def main(
             categories=categories,
             masks=masks,
             mask_threshold=mask_threshold)
+        flat_clickmaps, offsets = utils.pack_clickmaps(all_clickmaps)
+        num_subs = np.diff(offsets)
 
     # Compute null scores
     _, category_indices = np.unique(categories, return_inverse=True)
-    null_correlations = []
-    instance_correlations = {}
-    for _ in tqdm(range(null_iterations), total=null_iterations, desc="Computing null scores"):
-        results = Parallel(n_jobs=-1)(delayed(compute_inner_correlations)(i, all_clickmaps, category_indices, metric) for i in range(len(all_clickmaps)))
-        inner_correlations = [result[0] for result in results]
-        instance_correlations = {k: v for result in results for k, v in result[1].items()}
-        null_correlations.append(np.nanmean(inner_correlations))
-    null_correlations = np.asarray(null_correlations)
+    other_category_indices = {c: np.where(category_indices != c)[0] for c in np.unique(category_indices)}
+
+    # Reference map for each image is the mean of its subjects
+    reference_maps = utils.normalize_maps(np.stack([clickmaps.mean(0) for clickmaps in all_clickmaps]))
+
+    # Test map is a random subject from an image of a different category, drawn for every iteration at once
+    rand_maps = np.stack([np.random.choice(other_category_indices[c], size=null_iterations) for c in category_indices], axis=1)
+    rand_subs = np.random.randint(num_subs[rand_maps])
+    inner_correlations = utils.compute_pair_scores(flat_clickmaps, offsets[rand_maps] + rand_subs, reference_maps, metric)
+    null_correlations = np.nanmean(inner_correlations, axis=1)
+    if null_iterations:
+        instance_correlations = {i: [correlation] for i, correlation in enumerate(inner_correlations[-1])}
+    else:
+        instance_correlations = {}
     return final_clickmaps, instance_correlations, all_correlations, null_correlations, all_clickmaps
 
 
@@ -198,10 +175,42 @@ if __name__ == "__main__":
     else:
         metadata = None
 
-    # Load data
-    clickme_data = utils.process_clickme_data(
-        config["clickme_data"],
-        config["filter_mobile"])
+    # Prepared maps only depend on the data and the map settings, not the null iterations or metric
+    participant_checkpoint = utils.get_participant_checkpoint() if config["participant_filter"] else None
+    cache_file = utils.get_cache_file(
+        os.path.join(output_dir, "cache"),
+        clickme_data=config["clickme_data"],
+        clickme_data_mtime=os.path.getmtime(config["clickme_data"]),
+        filter_mobile=config["filter_mobile"],
+        image_path=config["image_path"],
+        metadata_file=config["metadata_file"],
+        metadata_file_mtime=utils.get_mtime(config["metadata_file"]),
+        blur_size=blur_size,
+        blur_sigma=blur_sigma,
+        min_pixels=min_pixels,
+        image_shape=config["image_shape"],
+        center_crop=config["center_crop"],
+        min_subjects=config["min_subjects"],
+        min_clicks=config["min_clicks"],
+        max_clicks=config["max_clicks"],
+        class_filter_file=config["class_filter_file"],
+        class_filter_file_mtime=utils.get_mtime(config["class_filter_file"]),
+        participant_filter=config["participant_filter"],
+        participant_checkpoint=participant_checkpoint,
+        participant_checkpoint_mtime=utils.get_mtime(participant_checkpoint),
+        participant_metadata_mtime=utils.get_mtime("participant_model_metadata.npz") if participant_checkpoint else None,
+        file_inclusion_filter=config["file_inclusion_filter"],
+        file_inclusion_filter_mtime=utils.get_mtime(config["file_inclusion_filter"]),
+        file_exclusion_filter=config["file_exclusion_filter"],
+        file_exclusion_filter_mtime=utils.get_mtime(config["file_exclusion_filter"]))
+
+    # Load data, unless the prepared maps are already cached
+    if os.path.exists(cache_file):
+        clickme_data = None
+    else:
+        clickme_data = utils.process_clickme_data(
+            config["clickme_data"],
+            config["filter_mobile"])
 
     # Process data
     final_clickmaps, instance_correlations, all_correlations, null_correlations, all_clickmaps = main(
@@ -224,7 +233,8 @@ if __name__ == "__main__":
         class_filter_file=config["class_filter_file"],
         participant_filter=config["participant_filter"],
         file_inclusion_filter=config["file_inclusion_filter"],
-        file_exclusion_filter=config["file_exclusion_filter"])
+        file_exclusion_filter=config["file_exclusion_filter"],
+        cache_file=cache_file)
     print(f"Mean human correlation full set: {np.nanmean(all_correlations)}")
     print(f"Null correlations full set: {np.nanmean(null_correlations)}")
     np.savez(
@@ -7,42 +7,30 @@ from tqdm import tqdm
 from joblib import Parallel, delayed
 
 
-def compute_inner_correlations(i, all_clickmaps, category_indices, metric):
-    category_index = category_indices[i]
-    inner_correlations = []
-    instance_correlations = {}
-
-    if i not in instance_correlations.keys():
-        instance_correlations[i] = []
-
-    # Reference map is the ith map
-    reference_map = all_clickmaps[i].mean(0)
-    reference_map = (reference_map - reference_map.min()) / (reference_map.max() - reference_map.min())
-
-    # Test map is a random subject from a different image
-    sub_vec = np.where(category_indices != category_index)[0]
-    rand_map = np.random.choice(sub_vec)
-    test_map = all_clickmaps[rand_map]
-    num_subs = len(test_map)
-    rand_sub = np.random.choice(num_subs)
-    test_map = test_map[rand_sub]
-    test_map = (test_map - test_map.min()) / (test_map.max() - test_map.min())
-
-    if metric.lower() == "crossentropy":
-        correlation = utils.compute_crossentropy(test_map, reference_map)
-    elif metric.lower() == "auc":
-        correlation = utils.compute_AUC(test_map, reference_map)
-    elif metric.lower() == "rsa":
-        correlation = utils.compute_RSA(test_map, reference_map)
-    elif metric.lower() == "spearman":
-        correlation = utils.compute_spearman_correlation(test_map, reference_map)
-    else:
-        raise ValueError(f"Invalid metric: {metric}")
-
-    inner_correlations.append(correlation)
-    instance_correlations[i].append(correlation)
-
-    return inner_correlations, instance_correlations
+def compute_split_half_correlations(clickmaps, randomization_iters, metric):
+    n = len(clickmaps)
+    test_maps = np.empty((randomization_iters,) + clickmaps.shape[1:], dtype=clickmaps.dtype)
+    remaining_maps = np.empty_like(test_maps)
+    for r in range(randomization_iters):
+        rand_perm = np.random.permutation(n)
+        fh = rand_perm[:(n // 2)]
+        sh = rand_perm[(n // 2):]
+        np.mean(clickmaps[fh], axis=0, out=test_maps[r])
+        np.mean(clickmaps[sh], axis=0, out=remaining_maps[r])
+    utils.normalize_maps(test_maps, out=test_maps)
+    utils.normalize_maps(remaining_maps, out=remaining_maps)
+    rand_corrs = []
+    for test_map, remaining_map in zip(test_maps, remaining_maps):
+        if metric.lower() == "crossentropy":
+            correlation = utils.compute_crossentropy(test_map, remaining_map)
+        elif metric.lower() == "auc":
+            correlation = utils.compute_AUC(test_map, remaining_map)
+        elif metric.lower() == "spearman":
+            correlation = utils.compute_spearman_correlation(test_map, remaining_map)
+        else:
+            raise ValueError(f"Invalid metric: {metric}")
+        rand_corrs.append(correlation)
+    return np.mean(rand_corrs)
 
 
 def main(
@@ -144,58 +132,30 @@ def main(
             plt.show()
 
     # Compute scores through split-halfs
-    all_correlations = []
-    for clickmaps in tqdm(all_clickmaps, desc="Processing ceiling", total=len(all_clickmaps)):
-        n = len(clickmaps)
-        rand_corrs = []
-        for _ in range(randomization_iters):
-            rand_perm = np.random.permutation(n)
-            fh = rand_perm[:(n // 2)]
-            sh = rand_perm[(n // 2):]
-            test_maps = clickmaps[fh].mean(0)
-            remaining_maps = clickmaps[sh].mean(0)
-            test_maps = (test_maps - test_maps.min()) / (test_maps.max() - test_maps.min())
-            remaining_maps = (remaining_maps - remaining_maps.min()) / (remaining_maps.max() - remaining_maps.min())
-            if metric.lower() == "crossentropy":
-                correlation = utils.compute_crossentropy(test_maps, remaining_maps)
-            elif metric.lower() == "auc":
-                correlation = utils.compute_AUC(test_maps, remaining_maps)
-            elif metric.lower() == "spearman":
-                correlation = utils.compute_spearman_correlation(test_maps, remaining_maps)
-            else:
-                raise ValueError(f"Invalid metric: {metric}")
-            rand_corrs.append(correlation)
-        all_correlations.append(np.mean(rand_corrs))
+    all_correlations = Parallel(n_jobs=-1)(delayed(compute_split_half_correlations)(clickmaps, randomization_iters, metric) for clickmaps in tqdm(all_clickmaps, desc="Processing ceiling", total=len(all_clickmaps)))
     all_correlations = np.asarray(all_correlations)
 
     # Compute null scores
-    null_correlations = []
+    flat_clickmaps, offsets = utils.pack_clickmaps(all_clickmaps)
+    num_subs = np.diff(offsets)
     click_len = len(all_clickmaps)
-    for _ in tqdm(range(null_iterations), total=null_iterations, desc="Computing null scores"):
-        inner_correlations = []
-        for i in range(click_len):
-            selected_clickmaps = all_clickmaps[i]
-            tmp_rng = np.arange(click_len)
-            j = tmp_rng[~np.in1d(tmp_rng, i)]
-            j = j[np.random.permutation(len(j))][0]  # Select a random other image
-            other_clickmaps = all_clickmaps[j]
-            rand_perm_sel = np.random.permutation(len(selected_clickmaps))
-            rand_perm_other = np.random.permutation(len(other_clickmaps))
-            fh = rand_perm_sel[:(len(selected_clickmaps) // 2)]
-            sh = rand_perm_other[(len(other_clickmaps) // 2):]
-            test_maps = selected_clickmaps[fh].mean(0)
-            remaining_maps = other_clickmaps[sh].mean(0)
-            test_maps = (test_maps - test_maps.min()) / (test_maps.max() - test_maps.min())
-            remaining_maps = (remaining_maps - remaining_maps.min()) / (remaining_maps.max() - remaining_maps.min())
-            if metric.lower() == "crossentropy":
-                correlation = utils.compute_crossentropy(test_maps, remaining_maps)
-            elif metric.lower() == "auc":
-                correlation = utils.compute_AUC(test_maps, remaining_maps)
-            elif metric.lower() == "spearman":
-                correlation = utils.compute_spearman_correlation(test_maps, remaining_maps)
-            else:
-                raise ValueError(f"Invalid metric: {metric}")
-            inner_correlations.append(correlation)
+    image_ids = np.repeat(np.arange(click_len), num_subs)
+
+    # Each image is compared against a random other image in every iteration
+    partners = np.random.randint(click_len - 1, size=(null_iterations, click_len))
+    partners += partners >= np.arange(click_len)
+
+    # Working buffers are shared by every null iteration
+    test_maps = np.empty((click_len,) + flat_clickmaps.shape[1:], dtype=flat_clickmaps.dtype)
+    remaining_maps = np.empty_like(test_maps)
+    null_correlations = []
+    for j in tqdm(partners, total=null_iterations, desc="Computing null scores"):
+        # Shuffle the subjects of every image at once, keeping them grouped by image
+        order = np.lexsort((np.random.random(len(flat_clickmaps)), image_ids))
+        utils.compute_segment_means(flat_clickmaps, order, offsets[:-1], offsets[:-1] + num_subs // 2, out=test_maps)
+        utils.compute_segment_means(flat_clickmaps, order, offsets[j] + num_subs[j] // 2, offsets[j + 1], out=remaining_maps)
+        utils.normalize_maps(remaining_maps, out=remaining_maps)  # Test maps are normalized inside compute_pair_scores
+        inner_correlations = utils.compute_pair_scores(test_maps, np.arange(click_len), remaining_maps, metric)
         null_correlations.append(np.nanmean(inner_correlations))
     null_correlations = np.asarray(null_correlations)
     return final_clickmaps, all_correlations, null_correlations, all_clickmaps
@@ -1,20 +1,30 @@
 import re
 import os
 import sys
+import hashlib
+import tempfile
 import torch
 import yaml
 import numpy as np
 import pandas as pd
 from torch.nn import functional as F
-from scipy.stats import spearmanr
+from scipy.stats import rankdata
+from scipy.special import logsumexp
 from tqdm import tqdm
 from torchvision.transforms import functional as tvF
 from scipy.spatial.distance import cdist
 from glob import glob
+from numba import njit, prange
 from train_subject_classifier import RNN
 from accelerate import Accelerator
 
 
+CLICK_PATTERN = re.compile(r"\((-?\d+),\s*(-?\d+)\)")  # Matches the "(x,y)" pairs in a clickmap string
+FASTMATH = {"reassoc", "contract"}  # Vectorize reductions, but keep exact divisions and NaN semantics for degenerate maps
+FFT_KERNEL_SIZE = 24  # convolve applies 2D kernels at least this wide with FFT convolution instead of direct conv2d
+CACHE_VERSION = 2  # Bump when map building changes so cached prepared maps are rebuilt
+
+
 def load_masks(mask_dir, wc="*.pth"):
     files = glob(os.path.join(mask_dir, wc))
     assert len(files), "No masks found in {}".format(mask_dir)
@@ -52,6 +62,20 @@ def filter_classes(
     return filtered_clickmaps
 
 
+def get_participant_checkpoint(ckpt_dir="checkpoints"):
+    """
+    Get the participant classifier checkpoint used by filter_participants.
+
+    Args:
+        ckpt_dir (str): Directory holding the classifier checkpoints.
+
+    Returns:
+        str: Path of the most recently modified checkpoint.
+    """
+    ckpts = glob(os.path.join(ckpt_dir, "*.pth"))
+    return sorted(ckpts, key=os.path.getmtime)[-1]
+
+
 def filter_participants(clickmaps, metadata_file="participant_model_metadata.npz", debug=False):
     metadata = np.load(metadata_file)
     max_x = metadata["max_x"]
@@ -64,8 +88,7 @@ def filter_participants(clickmaps, metadata_file="participant_model_metadata.npz
     device = accelerator.device
 
     # Load the model
-    ckpts = glob(os.path.join("checkpoints", "*.pth"))
-    sorted_ckpts = sorted(ckpts, key=os.path.getmtime)[-1]
+    sorted_ckpts = get_participant_checkpoint()
     model = RNN(input_dim, n_hidden, n_classes)
     model.load_state_dict(torch.load(sorted_ckpts))
     model.eval()
@@ -80,12 +103,12 @@ def filter_participants(clickmaps, metadata_file="participant_model_metadata.npz
             new_maps = []
             for map in maps:
                 clicks = np.asarray(map) // click_div
-                x_enc = np.zeros((len(clicks), max_x))
-                y_enc = np.zeros((len(clicks), max_y))
+                x_enc = np.zeros((len(clicks), max_x), dtype=np.float32)
+                y_enc = np.zeros((len(clicks), max_y), dtype=np.float32)
                 x_enc[:, clicks[:, 0]] = 1
                 y_enc[:, clicks[:, 1]] = 1
                 click_enc = np.concatenate((x_enc, y_enc), 1)
-                click_enc = torch.from_numpy(click_enc).float().to(device)
+                click_enc = torch.from_numpy(click_enc).to(device)
                 pred = model(click_enc[None])
                 if debug:
                     # Take the cheaters
@@ -214,6 +237,29 @@ def process_config(config_file):
     return config
 
 
+def parse_clickmap_string(clickmap):
+    """
+    Parse the clicks out of a clickmap string like '"{(x1,y1),(x2,y2)}"'.
+
+    Only the first {...} group holds clicks, anything after it is ignored.
+
+    Args:
+        clickmap (str): The clickmap string.
+
+    Returns:
+        list of tuple: The (x, y) clicks.
+
+    Raises:
+        ValueError: If the click group has content other than integer (x,y) pairs.
+    """
+    start = clickmap.find("{")
+    end = clickmap.find("}", start + 1)
+    clicks = clickmap[start + 1:end] if start >= 0 and end >= 0 else clickmap
+    if re.sub(r'[\s,"]', "", CLICK_PATTERN.sub("", clicks)):  # Pairs may be quoted, as in '{"(x1,y1)","(x2,y2)"}'
+        raise ValueError("Malformed clickmap: {}".format(clickmap))
+    return [(int(x), int(y)) for x, y in CLICK_PATTERN.findall(clicks)]
+
+
 def process_clickmap_files(
         clickme_data,
         min_clicks,
@@ -252,13 +298,10 @@ def process_clickmap_files(
                 continue
 
             if isinstance(clickmap, str):
-                clean_string = re.sub(r'[{}"]', '', clickmap)
-                tuple_strings = clean_string.split(', ')
-                data_list = tuple_strings[0].strip("()").split("),(")
-                if len(data_list) == 1:  # Remove empty clickmaps
+                tuples_list = parse_clickmap_string(clickmap)
+                if len(tuples_list) <= 1:  # Remove empty clickmaps
                     n_empty_clickmap += 1
                     continue
-                tuples_list = [tuple(map(int, pair.split(','))) for pair in data_list]
             else:
                 tuples_list = clickmap
                 if len(tuples_list) == 1:  # Remove empty clickmaps
@@ -337,17 +380,22 @@ def prepare_maps(
         max_kernel_size=51):
     
     assert blur_sigma_function is not None, "Blur sigma function not passed."
+    accelerator = Accelerator()
+    device = accelerator.device
+
     if kernel_type == "gaussian":
-        blur_kernel = gaussian_kernel(blur_size, blur_sigma)
+        blur_kernel = gaussian_kernel1d(blur_size, blur_sigma)
     elif kernel_type == "circle":
         blur_kernel = circle_kernel(blur_size, blur_sigma)
     else:
         raise NotImplementedError(kernel_type)
+    blur_kernel = blur_kernel.to(device)
 
     category_correlations = {}
     all_clickmaps = []
     keep_index = []
     categories = []
+    clickmap_buffer = None
     count = 0
     for image_key in tqdm(final_clickmaps, desc="Preparing maps", total=len(final_clickmaps)):
         count += 1
@@ -355,15 +403,13 @@ def prepare_maps(
         if category not in category_correlations.keys():
             category_correlations[category] = []
         image_trials = final_clickmaps[image_key]
-        # clickmaps = np.asarray([create_clickmap([trials], image_shape) for trials in image_trials])
-        # clickmaps = torch.from_numpy(clickmaps).float().unsqueeze(1)
         if metadata is not None:
             if image_key not in metadata:
                 print(f"Image key {image_key} not in metadata")
-                clickmaps = np.asarray([create_clickmap([trials], image_shape) for trials in image_trials])
-                clickmaps = torch.from_numpy(clickmaps).float().unsqueeze(1)
+                clickmap_buffer = get_clickmap_buffer(clickmap_buffer, len(image_trials), image_shape, device)
+                clickmaps = create_clickmaps(image_trials, image_shape, out=clickmap_buffer[:len(image_trials)])
                 if kernel_type == "gaussian":
-                    clickmaps = convolve(clickmaps, blur_kernel)
+                    clickmaps = gaussian_blur(clickmaps, blur_kernel)
                 elif kernel_type == "circle":
                     clickmaps = convolve(clickmaps, blur_kernel, double_conv=True)
                 else:
@@ -377,22 +423,22 @@ def prepare_maps(
                     adj_blur_size += 1  # Ensure odd kernel size
                 adj_blur_size = min(adj_blur_size, max_kernel_size)
                 adj_blur_sigma = blur_sigma_function(adj_blur_size)
-                clickmaps = np.asarray([create_clickmap([trials], native_size[::-1]) for trials in image_trials])
-                clickmaps = torch.from_numpy(clickmaps).float().unsqueeze(1)
+                clickmap_buffer = get_clickmap_buffer(clickmap_buffer, len(image_trials), native_size[::-1], device)
+                clickmaps = create_clickmaps(image_trials, native_size[::-1], out=clickmap_buffer[:len(image_trials)])
                 if kernel_type == "gaussian":
-                    adj_blur_kernel = gaussian_kernel(adj_blur_size, adj_blur_sigma)
-                    clickmaps = convolve(clickmaps, adj_blur_kernel)
+                    adj_blur_kernel = gaussian_kernel1d(adj_blur_size, adj_blur_sigma).to(device)
+                    clickmaps = gaussian_blur(clickmaps, adj_blur_kernel)
                 elif kernel_type == "circle":
-                    adj_blur_kernel = circle_kernel(adj_blur_size, adj_blur_sigma)
+                    adj_blur_kernel = circle_kernel(adj_blur_size, adj_blur_sigma).to(device)
                     clickmaps = convolve(clickmaps, adj_blur_kernel, double_conv=True)
                 else:
                     raise NotImplementedError(kernel_type)
                 del adj_blur_kernel
         else:
-            clickmaps = np.asarray([create_clickmap([trials], image_shape) for trials in image_trials])
-            clickmaps = torch.from_numpy(clickmaps).float().unsqueeze(1)
+            clickmap_buffer = get_clickmap_buffer(clickmap_buffer, len(image_trials), image_shape, device)
+            clickmaps = create_clickmaps(image_trials, image_shape, out=clickmap_buffer[:len(image_trials)])
             if kernel_type == "gaussian":
-                clickmaps = convolve(clickmaps, blur_kernel)
+                clickmaps = gaussian_blur(clickmaps, blur_kernel)
             elif kernel_type == "circle":
                 clickmaps = convolve(clickmaps, blur_kernel, double_conv=True)
             else:
@@ -401,7 +447,6 @@ def prepare_maps(
             clickmaps = tvF.resize(clickmaps, min(center_crop))
             clickmaps = tvF.center_crop(clickmaps, center_crop)
         clickmaps = clickmaps.squeeze()
-        clickmaps = clickmaps.numpy()
 
         # Filter 1: Remove empties
         if len(clickmaps.shape) == 2:
@@ -413,6 +458,9 @@ def prepare_maps(
         if len(clickmaps) < min_subjects:
             continue
 
+        # Only the surviving maps leave the device
+        clickmaps = clickmaps.cpu().numpy()
+
         # Filter 2: Remove duplicates
         clickmaps_vec = clickmaps.reshape(len(clickmaps), -1)
         dm = cdist(clickmaps_vec, clickmaps_vec)
@@ -433,6 +481,134 @@ def prepare_maps(
     return final_clickmaps, all_clickmaps, categories, keep_index
 
 
+def pack_clickmaps(all_clickmaps):
+    """
+    Pack per-image clickmap stacks into one contiguous array.
+
+    Args:
+        all_clickmaps (list of np.ndarray): One (trials, height, width) stack per image. All
+            stacks must share the same map shape, e.g. after center cropping.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - np.ndarray: A (total trials, height, width) array holding every image's maps.
+            - np.ndarray: Offsets such that image i's maps are flat[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.cumsum([0] + [len(clickmaps) for clickmaps in all_clickmaps])
+    return np.concatenate(all_clickmaps, 0), offsets
+
+
+def unpack_clickmaps(flat_clickmaps, offsets):
+    """
+    Split packed clickmaps back into per-image stacks without copying.
+
+    Args:
+        flat_clickmaps (np.ndarray): A (total trials, height, width) array from pack_clickmaps.
+        offsets (np.ndarray): Offsets such that image i's maps are flat[offsets[i]:offsets[i + 1]].
+
+    Returns:
+        list of np.ndarray: One (trials, height, width) view into flat_clickmaps per image.
+    """
+    return [flat_clickmaps[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def get_cache_file(cache_dir, **params):
+    """
+    Get the path of a prepared maps cache file.
+
+    Args:
+        cache_dir (str): Directory holding cache files.
+        **params: Every setting that affects the prepared maps.
+
+    Returns:
+        str: A path in cache_dir named by a hash of params and CACHE_VERSION.
+    """
+    params["cache_version"] = CACHE_VERSION
+    key = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()
+    return os.path.join(cache_dir, "{}.npz".format(key))
+
+
+def save_prepared_maps(cache_file, final_clickmaps, flat_clickmaps, offsets, categories):
+    """
+    Save the outputs of prepare_maps to a compressed cache file.
+
+    Args:
+        cache_file (str): Path of the cache file.
+        final_clickmaps (dict): Click trials for each kept image.
+        flat_clickmaps (np.ndarray): Blurred clickmaps for every kept image, from pack_clickmaps.
+        offsets (np.ndarray): Offsets of each image's maps in flat_clickmaps.
+        categories (list of str): Category of each kept image.
+    """
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary file first so an interrupted run never leaves a truncated cache hit
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(
+                f,
+                final_clickmaps=final_clickmaps,
+                flat_clickmaps=flat_clickmaps,
+                offsets=offsets,
+                categories=categories)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def get_mtime(path):
+    """
+    Get the modification time of an optional input file for a cache key.
+
+    Args:
+        path (str): Path of the file. May be empty, or a value that is not a file.
+
+    Returns:
+        float: The modification time, or None if path is not an existing file.
+    """
+    if path and isinstance(path, str) and os.path.isfile(path):
+        return os.path.getmtime(path)
+    return None
+
+
+def load_prepared_maps(cache_file):
+    """
+    Load prepare_maps outputs saved by save_prepared_maps.
+
+    Args:
+        cache_file (str): Path of the cache file.
+
+    Returns:
+        tuple: final_clickmaps, the packed flat_clickmaps and offsets, and categories.
+    """
+    data = np.load(cache_file, allow_pickle=True)
+    final_clickmaps = data["final_clickmaps"].item()
+    flat_clickmaps = data["flat_clickmaps"]
+    offsets = data["offsets"]
+    categories = data["categories"].tolist()
+    data.close()
+    return final_clickmaps, flat_clickmaps, offsets, categories
+
+
+def normalize_maps(maps, out=None):
+    """
+    Min-max normalize each map to [0, 1].
+
+    Args:
+        maps (np.ndarray): A 2D map or a stack of maps with shape (..., height, width).
+        out (np.ndarray, optional): Array to write the result into. May be maps itself.
+
+    Returns:
+        np.ndarray: The normalized maps, with the min and max taken per map.
+    """
+    map_min = maps.min((-2, -1), keepdims=True)
+    map_max = maps.max((-2, -1), keepdims=True)
+    out = np.subtract(maps, map_min, out=out)
+    return np.divide(out, map_max - map_min, out=out)
+
+
 def compute_average_map(trial_indices, clickmaps, resample=False):
     """
     Compute the average map from selected trials.
@@ -450,6 +626,70 @@ def compute_average_map(trial_indices, clickmaps, resample=False):
     return clickmaps[trial_indices].mean(0)
 
 
+def compute_percentile(values, thresh):
+    """
+    Compute a percentile with linear interpolation, matching np.percentile.
+
+    Uses np.partition to select the two neighbouring order statistics in linear
+    time instead of sorting the whole array.
+
+    Args:
+        values (array-like): The values.
+        thresh (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile of values.
+    """
+    values = np.asarray(values)
+    rank = (len(values) - 1) * thresh / 100
+    lower = int(np.floor(rank))
+    upper = min(lower + 1, len(values) - 1)
+    partitioned = np.partition(values, (lower, upper))
+    return partitioned[lower] + (partitioned[upper] - partitioned[lower]) * (rank - lower)
+
+
+def get_medians(point_lists, mode='image', thresh=50):
+    """
+    Compute a percentile of the number of clicks per clickmap.
+
+    Args:
+        point_lists (dict): Click trials for each image, keyed by "category/image".
+        mode (str): Group the clickmaps by 'image', by 'category' or over 'all' of them.
+        thresh (float): The percentile, between 0 and 100.
+
+    Returns:
+        dict: The percentile for each group, keyed by image, category, or 'all'.
+    """
+    medians = {}
+    if mode == 'image':
+        for image in point_lists:
+            clickmaps = point_lists[image]
+            num_clicks = []
+            for clickmap in clickmaps:
+                num_clicks.append(len(clickmap))
+            medians[image] = compute_percentile(num_clicks, thresh)
+    elif mode == 'category':
+        for image in point_lists:
+            category = image.split('/')[0]
+            if category not in medians.keys():
+                medians[category] = []
+            clickmaps = point_lists[image]
+            for clickmap in clickmaps:
+                medians[category].append(len(clickmap))
+        for category in medians:
+            medians[category] = compute_percentile(medians[category], thresh)
+    elif mode == 'all':
+        num_clicks = []
+        for image in point_lists:
+            clickmaps = point_lists[image]
+            for clickmap in clickmaps:
+                num_clicks.append(len(clickmap))
+        medians['all'] = compute_percentile(num_clicks, thresh)
+    else:
+        raise NotImplementedError(mode)
+    return medians
+
+
 def compute_spearman_correlation(map1, map2):
     """
     Compute the Spearman correlation between two maps.
@@ -461,16 +701,34 @@ def compute_spearman_correlation(map1, map2):
     Returns:
         float: The Spearman correlation coefficient, or NaN if computation is not possible.
     """
-    filtered_map1 = map1.flatten()
-    filtered_map2 = map2.flatten()
-
-    if filtered_map1.size > 1 and filtered_map2.size > 1:
-        correlation, _ = spearmanr(filtered_map1, filtered_map2)
-        return correlation
+    if map1.size > 1 and map2.size > 1:
+        return float(compute_ranks(map1)[0] @ compute_ranks(map2)[0])
     else:
         return float('nan')
 
 
+def compute_ranks(maps):
+    """
+    Rank the pixels of one or more maps for Spearman correlation.
+
+    Ties get their average rank, as in scipy.stats.spearmanr. The ranks are centered
+    and scaled to unit norm, so the Spearman correlation of two maps is the dot
+    product of their rows.
+
+    Args:
+        maps (np.ndarray): A 2D map or a 3D stack of maps.
+
+    Returns:
+        np.ndarray: A (maps, pixels) array of normalized ranks. Constant maps give NaN rows.
+    """
+    maps = np.asarray(maps)
+    ranks = rankdata(maps.reshape(-1, maps.shape[-2] * maps.shape[-1]), axis=1)
+    ranks -= ranks.mean(1, keepdims=True)
+    with np.errstate(invalid="ignore"):
+        ranks /= np.linalg.norm(ranks, axis=1, keepdims=True)
+    return ranks
+
+
 def fast_ious(v1, v2):
     """
     Compute the IoU between two images.
@@ -492,29 +750,48 @@ def fast_ious(v1, v2):
     return iou
     
 
-def gaussian_kernel(size, sigma):
+def gaussian_kernel1d(size, sigma):
     """
-    Create a Gaussian kernel.
+    Create a 1D Gaussian kernel.
+
+    The 2D Gaussian is separable, so blurring with this kernel along rows and then
+    columns (see gaussian_blur) is equivalent to a single size x size convolution.
 
     Args:
         size (int): Size of the kernel.
         sigma (float): Standard deviation of the Gaussian distribution.
 
     Returns:
-        torch.Tensor: A 2D Gaussian kernel with added batch and channel dimensions.
+        torch.Tensor: A 1D Gaussian kernel of shape (1, 1, 1, size), normalized to sum to 1.
     """
     x_range = torch.arange(-(size-1)//2, (size-1)//2 + 1, 1)
-    y_range = torch.arange((size-1)//2, -(size-1)//2 - 1, -1)
+    kernel = torch.exp(-(x_range ** 2) / (2 * sigma**2))
 
-    xs, ys = torch.meshgrid(x_range, y_range, indexing='ij')
-    kernel = torch.exp(-(xs**2 + ys**2) / (2 * sigma**2)) / (2 * np.pi * sigma**2)
-    
     kernel = kernel / kernel.sum()
-    kernel = kernel.unsqueeze(0).unsqueeze(0)
-    
+    kernel = kernel.view(1, 1, 1, -1)
+
     return kernel
 
 
+def gaussian_blur(heatmap, kernel_h, kernel_w=None):
+    """
+    Apply a separable Gaussian blur to a heatmap.
+
+    Args:
+        heatmap (torch.Tensor): The input heatmap (4D tensor).
+        kernel_h (torch.Tensor): The 1D Gaussian kernel of shape (1, 1, 1, k).
+        kernel_w (torch.Tensor, optional): The vertical kernel. Defaults to the transpose of kernel_h.
+
+    Returns:
+        torch.Tensor: The blurred heatmap (4D tensor).
+    """
+    if kernel_w is None:
+        kernel_w = kernel_h.transpose(-1, -2)
+    blurred_heatmap = F.conv2d(heatmap, kernel_h, padding='same')
+    blurred_heatmap = F.conv2d(blurred_heatmap, kernel_w, padding='same')
+    return blurred_heatmap
+
+
 def convolve(heatmap, kernel, double_conv=False):
     """
     Apply Gaussian blur to a heatmap.
@@ -527,12 +804,54 @@ def convolve(heatmap, kernel, double_conv=False):
         torch.Tensor: The blurred heatmap (3D tensor).
     """
     # heatmap = heatmap.unsqueeze(0) if heatmap.dim() == 3 else heatmap
-    blurred_heatmap = F.conv2d(heatmap, kernel, padding='same')
+    conv = fft_convolve if max(kernel.shape[-2:]) >= FFT_KERNEL_SIZE else lambda x, k: F.conv2d(x, k, padding='same')
+    blurred_heatmap = conv(heatmap, kernel)
     if double_conv:
-        blurred_heatmap = F.conv2d(blurred_heatmap, kernel, padding='same')
+        blurred_heatmap = conv(blurred_heatmap, kernel)
     return blurred_heatmap  # [0]
 
 
+def fft_convolve(heatmap, kernel):
+    """
+    Apply a kernel to a batch of heatmaps with FFT convolution.
+
+    Matches F.conv2d(heatmap, kernel, padding='same') to float precision, but its cost does not
+    grow with the kernel size, so it is faster for large blurs. Heatmaps and kernel must be
+    non-negative, as clickmaps and blur kernels are, so that (maps > 0) agrees with conv2d.
+
+    Args:
+        heatmap (torch.Tensor): The input heatmaps (4D tensor).
+        kernel (torch.Tensor): The kernel of shape (1, 1, kh, kw).
+
+    Returns:
+        torch.Tensor: The blurred heatmaps (4D tensor).
+    """
+    blurred_heatmap = _fft_convolve_same(heatmap, kernel)
+
+    # FFT round-off leaves noise around zero everywhere, and can swamp true tail values far below
+    # the map max. Blurring the click mask with the kernel footprint gives integer overlap counts,
+    # which survive round-off, so it marks exactly the pixels conv2d makes positive.
+    support = _fft_convolve_same((heatmap != 0).to(heatmap.dtype), (kernel != 0).to(kernel.dtype)) > 0.5
+    blurred_heatmap.clamp_(min=torch.finfo(blurred_heatmap.dtype).tiny)
+    blurred_heatmap[~support] = 0
+    return blurred_heatmap
+
+
+def _fft_convolve_same(heatmap, kernel):
+    height, width = heatmap.shape[-2:]
+    kernel_height, kernel_width = kernel.shape[-2:]
+    fft_size = (height + kernel_height - 1, width + kernel_width - 1)
+
+    # conv2d is a cross-correlation, so flip the kernel for a true convolution
+    spectrum = torch.fft.rfft2(heatmap, s=fft_size) * torch.fft.rfft2(kernel.flip(-2, -1), s=fft_size)
+    blurred_heatmap = torch.fft.irfft2(spectrum, s=fft_size)
+
+    # Crop the full convolution to the window that padding='same' keeps
+    top = kernel_height - 1 - (kernel_height - 1) // 2
+    left = kernel_width - 1 - (kernel_width - 1) // 2
+    return blurred_heatmap[..., top:top + height, left:left + width].contiguous()
+
+
 def integrate_surface(iou_scores, x, z, average_areas=True, normalize=False):
     # Integrate along x axis (classifier thresholds)
     if len(z) == 1:
@@ -592,10 +911,10 @@ def compute_AUC(
     # thresholds = [0.25, 0.5, 0.75, 1]
     thresh_ious = []
     for outer_t in target_thresholds:
-        thresh_target_map = (target_map >= outer_t).astype(int).ravel()
+        thresh_target_map = (target_map >= outer_t).ravel()
         ious = []
         for t in inner_thresholds:
-            thresh_pred_map = (pred_map >= t).astype(int).ravel()
+            thresh_pred_map = (pred_map >= t).ravel()
             iou = fast_ious(thresh_target_map, thresh_pred_map)
             ious.append(iou)
         thresh_ious.append(np.asarray(ious))
@@ -607,43 +926,198 @@ def compute_crossentropy(map1, map2):
     """
     Compute the cross-entropy between two maps.
 
+    Matches F.cross_entropy with map1 as the logits and map2 as soft targets.
+
     Args:
         map1 (np.ndarray): The first map.
-        map2 (np.ndarray): The second map.  
+        map2 (np.ndarray): The second map.
 
     Returns:
         float: The cross-entropy between the two maps.
     """
-    map1 = torch.from_numpy(map1).float().ravel()
-    map2 = torch.from_numpy(map2).float().ravel()
-    return F.cross_entropy(map1, map2).numpy()
+    map1 = np.asarray(map1, dtype=np.float32).ravel()
+    map2 = np.asarray(map2, dtype=np.float32).ravel()
+    return float(map2 @ (logsumexp(map1) - map1))
 
 
-def create_clickmap(point_lists, image_shape, exponential_decay=False, tau=0.5):
+def compute_segment_means(flat_clickmaps, indices, starts, ends, out=None):
     """
-    Create a clickmap from click points.
+    Average groups of maps from flat_clickmaps without gathering them into a copy first.
 
     Args:
-        click_points (list of tuples): List of (x, y) coordinates where clicks occurred.
-        image_shape (tuple): Shape of the image (height, width).
-        blur_kernel (torch.Tensor, optional): Gaussian kernel for blurring. Default is None.
-        tau (float, optional): Decay rate for exponential decay. Default is 0.5 but this needs to be tuned.
+        flat_clickmaps (np.ndarray): (total trials, height, width) clickmaps from pack_clickmaps.
+        indices (np.ndarray): Indices into flat_clickmaps. Group i is indices[starts[i]:ends[i]].
+        starts (np.ndarray): Start of each group in indices.
+        ends (np.ndarray): End of each group in indices.
+        out (np.ndarray, optional): (groups, height, width) array to write the means into.
 
     Returns:
-        np.ndarray: A 2D array representing the clickmap, blurred if kernel provided.
+        np.ndarray: The (groups, height, width) mean map of each group.
+    """
+    if out is None:
+        out = np.empty((len(starts),) + flat_clickmaps.shape[1:], dtype=flat_clickmaps.dtype)
+    _segment_means(
+        flat_clickmaps.reshape(len(flat_clickmaps), -1),
+        np.asarray(indices, dtype=np.int64),
+        np.asarray(starts, dtype=np.int64),
+        np.asarray(ends, dtype=np.int64),
+        out.reshape(len(out), -1))
+    return out
+
+
+def compute_pair_scores(flat_clickmaps, test_indices, reference_maps, metric):
     """
-    heatmap = np.zeros(image_shape, dtype=np.uint8)
-    for click_points in point_lists:
-        if exponential_decay:
-            for idx, point in enumerate(click_points):
+    Score each reference map against test maps drawn from flat_clickmaps.
+
+    Used for both ceiling and null scores. AUC and cross-entropy pairs are scored in
+    parallel with numba, Spearman pairs with batches of scipy ranks, matching compute_AUC,
+    compute_crossentropy and compute_spearman_correlation called with the test map first.
+
+    The two sides are normalized asymmetrically: test maps are taken raw from
+    flat_clickmaps and min-max normalized inside the kernel, while reference maps are
+    used as given, so callers must normalize them first (e.g. with normalize_maps).
+
+    Args:
+        flat_clickmaps (np.ndarray): (total trials, height, width) unnormalized clickmaps,
+            e.g. from pack_clickmaps.
+        test_indices (np.ndarray): (..., references) indices into flat_clickmaps. The last axis
+            pairs a test map with each reference map, e.g. one row per null iteration.
+        reference_maps (np.ndarray): (references, height, width) maps, already normalized.
+        metric (str): The metric to compute (auc, crossentropy or spearman).
 
-                if 0 <= point[1] < image_shape[0] and 0 <= point[0] < image_shape[1]:
-                    heatmap[point[1], point[0]] += np.exp(-idx / tau)
+    Returns:
+        np.ndarray: The score for each entry of test_indices.
+    """
+    test_indices = np.asarray(test_indices, dtype=np.int64)
+    assert test_indices.shape[-1] == len(reference_maps), "Need one test map per reference map."
+    if metric.lower() == "spearman":
+        # rankdata sorts faster than numba on real clickmaps, even with a single thread
+        return _pair_spearman(flat_clickmaps, test_indices.ravel(), reference_maps).reshape(test_indices.shape)
+    flat_clickmaps = flat_clickmaps.reshape(len(flat_clickmaps), -1)
+    reference_maps = reference_maps.reshape(len(reference_maps), -1)
+    if metric.lower() == "crossentropy":
+        scores = _pair_crossentropy(flat_clickmaps, test_indices.ravel(), reference_maps)
+    elif metric.lower() == "auc":
+        scores = _pair_auc(
+            flat_clickmaps,
+            test_indices.ravel(),
+            reference_maps,
+            np.linspace(0, 1, 21),
+            np.linspace(0.25, 0.75, 9))
+    else:
+        raise ValueError(f"Invalid metric: {metric}")
+    return scores.reshape(test_indices.shape)
+
+
+@njit(parallel=True, cache=True)
+def _segment_means(flat_clickmaps, indices, starts, ends, out):
+    for i in prange(len(starts)):
+        out[i] = 0
+        for k in range(starts[i], ends[i]):
+            out[i] += flat_clickmaps[indices[k]]
+        out[i] /= ends[i] - starts[i]
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _normalize_map(values):
+    return (values - values.min()) / (values.max() - values.min())
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _pair_crossentropy(flat_clickmaps, test_indices, reference_maps):
+    # Soft-target cross-entropy with the test map as logits, as in F.cross_entropy
+    scores = np.empty(len(test_indices))
+    for i in prange(len(test_indices)):
+        logits = _normalize_map(flat_clickmaps[test_indices[i]])
+        target = reference_maps[i % len(reference_maps)]
+        max_logit = logits.max()
+        log_sum_exp = max_logit + np.log(np.exp(logits - max_logit).sum())
+        scores[i] = (target * (log_sum_exp - logits)).sum()
+    return scores
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _pair_auc(flat_clickmaps, test_indices, reference_maps, prediction_thresholds, target_thresholds):
+    scores = np.empty(len(test_indices))
+    for i in prange(len(test_indices)):
+        pred_map = _normalize_map(flat_clickmaps[test_indices[i]])
+        target_map = reference_maps[i % len(reference_maps)]
+        ious = np.empty((len(target_thresholds), len(prediction_thresholds)))
+        for j in range(len(target_thresholds)):
+            thresh_target_map = target_map >= target_thresholds[j]
+            for k in range(len(prediction_thresholds)):
+                thresh_pred_map = pred_map >= prediction_thresholds[k]
+                union = (thresh_target_map | thresh_pred_map).sum()
+                ious[j, k] = (thresh_target_map & thresh_pred_map).sum() / union if union != 0 else 0.0
+
+        # Average the areas under each target threshold's IoU curve, as in integrate_surface
+        if len(target_thresholds) == 1:
+            scores[i] = ious.mean()
         else:
-            for point in click_points:
-                if 0 <= point[1] < image_shape[0] and 0 <= point[0] < image_shape[1]:
-                    heatmap[point[1], point[0]] += 1
-    return heatmap
+            areas = np.diff(prediction_thresholds) * (ious[:, 1:] + ious[:, :-1]) / 2
+            scores[i] = areas.sum() / len(target_thresholds)
+    return scores
+
+
+def _pair_spearman(flat_clickmaps, test_indices, reference_maps, chunk_size=256):
+    # Rank each reference map once, then rank the test maps in chunks to bound memory
+    reference_ranks = compute_ranks(reference_maps)
+    scores = np.empty(len(test_indices))
+    for start in range(0, len(test_indices), chunk_size):
+        chunk = np.arange(start, min(start + chunk_size, len(test_indices)))
+        with np.errstate(invalid="ignore"):
+            test_ranks = compute_ranks(normalize_maps(flat_clickmaps[test_indices[chunk]]))
+        scores[chunk] = np.einsum("ij,ij->i", test_ranks, reference_ranks[chunk % len(reference_maps)])
+    return scores
+
+
+def get_clickmap_buffer(buffer, num_trials, image_shape, device="cpu"):
+    """
+    Get a buffer that can hold num_trials clickmaps, reusing buffer when it is large enough.
+
+    Args:
+        buffer (torch.Tensor or None): The previously used buffer.
+        num_trials (int): Number of clickmaps the buffer must hold.
+        image_shape (tuple): Shape of the image (height, width).
+        device (torch.device or str, optional): Device to allocate on. Default is "cpu".
+
+    Returns:
+        torch.Tensor: A (trials, 1, height, width) float32 buffer with at least num_trials maps.
+    """
+    height, width = image_shape
+    if buffer is None or tuple(buffer.shape[2:]) != (height, width) or len(buffer) < num_trials:
+        buffer = torch.empty((num_trials, 1, height, width), dtype=torch.float32, device=device)
+    return buffer
+
+
+def create_clickmaps(point_lists, image_shape, device="cpu", out=None):
+    """
+    Create a stack of clickmaps, one per trial, from click points.
+
+    Args:
+        point_lists (list of lists of tuples): One list of (x, y) click coordinates per trial.
+        image_shape (tuple): Shape of the image (height, width).
+        device (torch.device or str, optional): Device to build the stack on. Default is "cpu".
+        out (torch.Tensor, optional): A (trials, 1, height, width) tensor to write into instead of allocating.
+
+    Returns:
+        torch.Tensor: A (trials, 1, height, width) float32 tensor of click counts.
+    """
+    height, width = image_shape
+    if out is None:
+        clickmaps = torch.zeros((len(point_lists), 1, height, width), dtype=torch.float32, device=device)
+    else:
+        clickmaps = out.zero_()
+        device = clickmaps.device
+
+    # Gather every (trial, y, x) click and scatter them into the stack in one call
+    points = np.concatenate([np.asarray(click_points, dtype=np.int64).reshape(-1, 2) for click_points in point_lists])
+    trial_ids = np.repeat(np.arange(len(point_lists)), [len(click_points) for click_points in point_lists])
+    xs, ys = points[:, 0], points[:, 1]
+    in_bounds = (0 <= ys) & (ys < height) & (0 <= xs) & (xs < width)
+    indices = tuple(torch.from_numpy(v[in_bounds]).to(device) for v in (trial_ids, ys, xs))
+    clickmaps[:, 0].index_put_(indices, torch.ones(len(indices[0]), device=device), accumulate=True)
+    return clickmaps
 
 
 def alt_gaussian_kernel(size=10, sigma=10):
@@ -5,37 +5,6 @@ from skimage import io
 from tqdm import tqdm
 
 
-def get_medians(point_lists, mode='image', thresh=50):
-    medians = {}
-    if mode == 'image':
-        for image in point_lists:
-            clickmaps = point_lists[image]
-            num_clicks = []
-            for clickmap in clickmaps:
-                num_clicks.append(len(clickmap))
-            medians[image] = np.percentile(num_clicks, thresh)
-    elif mode == 'category':
-        for image in point_lists:
-            category = image.split('/')[0]
-            if category not in medians.keys():
-                medians[category] = []
-            clickmaps = point_lists[image]
-            for clickmap in clickmaps:
-                medians[category].append(len(clickmap))
-        for category in medians:
-            medians[category] = np.percentile(medians[category], thresh)
-    elif mode == 'all':
-        num_clicks = []
-        for image in point_lists:
-            clickmaps = point_lists[image]
-            for clickmap in clickmaps:
-                num_clicks.append(len(clickmap))
-        medians['all'] = np.percentile(num_clicks, thresh)
-    else:
-        raise NotImplementedError(mode)
-    return medians
-
-
 if __name__ == "__main__":
 
     # Get config file